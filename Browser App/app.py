@@ -21,7 +21,15 @@ from matplotlib import cm
 from PIL import Image
 import pandas as pd
 import io
+import json
+import re
+import shutil
+import uuid
 import zipfile 
+from datetime import datetime
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 
 Image.MAX_IMAGE_PIXELS = 500000000
 
@@ -75,11 +83,7 @@ def fetch_dzi():
     return {"files": dzi_files}
 
 
-class SegmentPayload(BaseModel):
-    data: Optional[List[int]] = Field(None, description="Flattened RGBA bytes")
-    width: Optional[int] = None
-    height: Optional[int] = None
-    image_path: Optional[Path] = Field(None, description="Path to a PNG/JPEG/etc.")
+class SegmentParams(BaseModel):
     h_min: float
     h_max: float
     s_min: float
@@ -91,9 +95,16 @@ class SegmentPayload(BaseModel):
     min_distance: int = 45
     dilate: int = 1
     smooth_radius: int = 0
-    filename: str
     morphfilter: dict
 
+
+class SegmentPayload(SegmentParams):
+    data: Optional[List[int]] = Field(None, description="Flattened RGBA bytes")
+    width: Optional[int] = None
+    height: Optional[int] = None
+    image_path: Optional[Path] = Field(None, description="Path to a PNG/JPEG/etc.")
+    filename: str
+
     @model_validator(mode="after")
     def _validate_inputs(self):
         if (self.data is None) == (self.image_path is None):
@@ -129,32 +140,200 @@ class SegmentPayload(BaseModel):
 
         return rgba
 
+def segment_kwargs(params: SegmentParams) -> dict:
+    """Map request parameters onto segment_pipeline.segment arguments."""
+    return dict(
+        h_range=(params.h_min, params.h_max),
+        s_range=(params.s_min, params.s_max),
+        v_range=(params.v_min, params.v_max),
+        min_distance = params.min_distance,
+        dilate_iters=params.dilate,
+        smooth_radius=params.smooth_radius,
+        do_morphology=params.do_morphology,
+        do_watershed=params.do_watershed,
+        morphfilter=params.morphfilter
+    )
+
+
+# File ownership:
+#   /segment        -> cache/mask/<name>.png, cache/mask/tmp/<name>.npy and .parquet
+#                      (read by /morphology and /exportPollen)
+#   /segment_batch  -> cache/mask/tmp/batch/<batch_id>/ only (read by /morphology_batch),
+#                      so a batch never replaces interactive results.
+def run_segmentation(rgb: np.ndarray, params: SegmentParams, filename: str) -> pd.DataFrame:
+    """Segment one image, store overlay/mask/morphology under cache/mask and return the morphology table."""
+    # Call your pipeline with mapped params
+    filtered_labels, labels, mask, morphology_data = segment_pipeline.segment(img_roi=rgb, **segment_kwargs(params))
+
+    segment_pipeline.make_overlay_png(filtered_labels, morphology_data, out_path="./cache/mask/{}.png".format(filename), alpha=200)
+
+    #Store mask as np array and download the pandas data frame.
+    np.save("cache/mask/tmp/{}.npy".format(filename), filtered_labels)
+    morphology_data.to_parquet("cache/mask/tmp/{}.parquet".format(filename))
+
+    return morphology_data
+
+
 @app.post("/segment")
 async def segment_image(payload: SegmentPayload):
     
     rgb = payload.to_image()
     print(payload.do_watershed)
-    # Call your pipeline with mapped params
-    filtered_labels, labels, mask, morphology_data = segment_pipeline.segment(
-        img_roi=rgb,
-        h_range=(payload.h_min, payload.h_max),
-        s_range=(payload.s_min, payload.s_max),
-        v_range=(payload.v_min, payload.v_max),
-        min_distance = payload.min_distance,
-        dilate_iters=payload.dilate,
-        smooth_radius=payload.smooth_radius,
-        do_morphology=payload.do_morphology,
-        do_watershed=payload.do_watershed,
-        morphfilter=payload.morphfilter
-    )
+    morphology_data = run_segmentation(rgb, payload, payload.filename)
 
-    segment_pipeline.make_overlay_png(filtered_labels, morphology_data, out_path="./cache/mask/{}.png".format(payload.filename), alpha=200)
+    return JSONResponse(content={"measurements" : morphology_data.to_dict(orient="records")})
 
-    #Store mask as np array and download the pandas data frame.
-    np.save("cache/mask/tmp/{}.npy".format(payload.filename), filtered_labels)
-    morphology_data.to_parquet("cache/mask/tmp/{}.parquet".format(payload.filename))
 
-    return JSONResponse(content={"measurements" : morphology_data.to_dict(orient="records")})
+# Peak working set of one batch slide per pixel: PNG load, segment_pipeline.segment
+# (float64 HSV planes in rgb2hsv, distance transform, label images), overlay and
+# mask writing. Measured with tracemalloc on synthetic 1, 4 and 16 MP slides
+# (109 B/px at every size, RSS agreed); rounded up for PIL buffers tracemalloc misses.
+BATCH_BYTES_PER_PIXEL = 128
+# Share of physical RAM used as memory budget when max_memory_mb is not given.
+BATCH_MEMORY_FRACTION = 0.5
+BATCH_MEMORY_FALLBACK = 4 * 1024 ** 3
+# Slides run in separate processes: most of segment() holds the GIL. "spawn"
+# avoids forking the server's threads.
+BATCH_EXECUTOR = partial(ProcessPoolExecutor, mp_context=multiprocessing.get_context("spawn"))
+BATCH_DIR = Path("cache/mask/tmp/batch")
+BATCH_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]+")
+
+
+def batch_dir(batch_id: str) -> Path:
+    """Return cache/mask/tmp/batch/<batch_id>, rejecting ids that could leave that folder."""
+    if not BATCH_ID_PATTERN.fullmatch(batch_id):
+        raise HTTPException(400, f"Invalid batch_id {batch_id!r}: use only letters, digits, '_' and '-'")
+    out_dir = (BATCH_DIR / batch_id).resolve()
+    if out_dir.parent != BATCH_DIR.resolve():
+        raise HTTPException(400, f"Invalid batch_id {batch_id!r}")
+    return out_dir
+
+
+def default_batch_memory() -> int:
+    """Memory budget (bytes) for a batch: a fraction of physical RAM, or a fixed fallback where that is unknown."""
+    try:
+        total = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        # os.sysconf does not exist on Windows
+        return BATCH_MEMORY_FALLBACK
+    return int(total * BATCH_MEMORY_FRACTION)
+
+
+class BatchSegmentPayload(SegmentParams):
+    filenames: Optional[List[str]] = Field(None, description="Slides in cache/png (without .png). All slides when omitted.")
+    batch_id: Optional[str] = Field(None, description="Name of the combined result (letters, digits, '_', '-'). Defaults to a timestamp plus a random suffix.")
+    overwrite: bool = Field(False, description="Replace an existing result with the same batch_id.")
+    max_workers: Optional[int] = Field(None, ge=1, description="Slides segmented at once. Defaults to the CPU count.")
+    max_memory_mb: Optional[int] = Field(None, ge=1, description="Memory budget shared by running slides. Defaults to half of physical RAM.")
+
+
+@app.post("/segment_batch")
+def segment_batch(payload: BatchSegmentPayload):
+    """
+    Segment several slides from cache/png with one parameter set.
+
+    Streams one NDJSON line per slide as it finishes, then a summary line.
+    Everything goes to cache/mask/tmp/batch/<batch_id>: overlays and label
+    masks in slides/, and the combined morphology table in morphology/ as
+    Parquet partitioned by slide.
+    """
+    png_dir = Path("cache/png")
+    if payload.filenames is None:
+        slides = sorted(p.stem for p in png_dir.glob("*.png"))
+    else:
+        # Drop duplicates so no two workers write the same slide's files
+        slides = list(dict.fromkeys(Path(f).name.removesuffix(".png") for f in payload.filenames))
+    missing = [s for s in slides if not (png_dir / f"{s}.png").exists()]
+    if missing:
+        raise HTTPException(404, f"Not found in {png_dir}: {missing}")
+    if not slides:
+        raise HTTPException(400, "No slides to segment")
+
+    batch_id = payload.batch_id or "{}-{}".format(datetime.now().strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:8])
+    out_dir = batch_dir(batch_id)
+    if out_dir.exists() and not payload.overwrite:
+        raise HTTPException(409, f"Batch {batch_id!r} already exists. Set overwrite to replace it.")
+
+    # Read slide sizes before streaming starts, so unreadable files still get a proper error response
+    costs, unreadable = {}, []
+    for slide in slides:
+        try:
+            with Image.open(png_dir / f"{slide}.png") as img:
+                width, height = img.size
+        except OSError:
+            unreadable.append(slide)
+            continue
+        costs[slide] = width * height * BATCH_BYTES_PER_PIXEL
+    if unreadable:
+        raise HTTPException(400, f"Not readable as images: {unreadable}")
+    memory_budget = payload.max_memory_mb * 1024 ** 2 if payload.max_memory_mb else default_batch_memory()
+
+    # Replace rather than mix with files of an earlier run with the same id
+    shutil.rmtree(out_dir, ignore_errors=True)
+    slides_dir = out_dir / "slides"
+    table_dir = out_dir / "morphology"
+    slides_dir.mkdir(parents=True)
+
+    def stream():
+        frames, counts = [], {}
+        results = segment_pipeline.schedule_batch(
+            slides,
+            partial(
+                segment_pipeline.segment_slide,
+                png_dir=str(png_dir.resolve()),
+                out_dir=str(slides_dir),
+                segment_kwargs=segment_kwargs(payload),
+            ),
+            cost=costs.get,
+            max_workers=payload.max_workers,
+            memory_budget=memory_budget,
+            executor=BATCH_EXECUTOR,
+        )
+        for slide, morphology_data, error in results:
+            if error is not None:
+                yield json.dumps({"slide": slide, "error": str(error)}) + "\n"
+                continue
+            counts[slide] = len(morphology_data)
+            if len(morphology_data):
+                frames.append(morphology_data.assign(slide=slide))
+            yield json.dumps({
+                "slide": slide,
+                "count": counts[slide],
+                "measurements": morphology_data.to_dict(orient="records"),
+            }, default=str) + "\n"
+
+        write_error = None
+        try:
+            if frames:
+                combined = pd.concat(frames, ignore_index=True)
+                combined.to_parquet(table_dir, partition_cols=["slide"])
+        except Exception as e:
+            write_error = str(e)
+
+        yield json.dumps({
+            "batch_id": batch_id,
+            "counts": counts,
+            "total": sum(counts.values()),
+            "failed": [s for s in slides if s not in counts],
+            "parquet": str(BATCH_DIR / batch_id / "morphology") if table_dir.exists() else None,
+            "error": write_error,
+        }) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@app.get("/morphology_batch/{batch_id}")
+def download_batch_csv(batch_id: str):
+    p = batch_dir(batch_id) / "morphology"
+    if not p.exists():
+        raise HTTPException(404, f"Not found: {BATCH_DIR / batch_id / 'morphology'}")
+    df = pd.read_parquet(p)  # partition column comes back as "slide"
+    csv_text = df.to_csv(index=False)
+    return Response(
+        content=csv_text,
+        media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{batch_id}.csv"'},
+    )
 
 @app.get("/morphology/{filename}")
 def download_csv(filename: str):
@@ -3,4 +3,5 @@ from .export_labelled_objects import export_labelled_objects
 from .hsv_threshold import hsv_threshold
 from .filter_objects import filter_objects
 from .measure_morphology import measure_morphology
-from .segment import segment
\ No newline at end of file
+from .segment import segment
+from .batch_segment import schedule_batch, segment_slide
\ No newline at end of file
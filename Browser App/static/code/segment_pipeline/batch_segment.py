@@ -0,0 +1,88 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from .colorize_and_number import make_overlay_png
+from .segment import segment
+
+# Same limit as app.py, which worker processes do not import
+Image.MAX_IMAGE_PIXELS = 500000000
+
+
+def segment_slide(slide: str, png_dir, out_dir, segment_kwargs: dict) -> pd.DataFrame:
+    """
+    Segment <png_dir>/<slide>.png and store its overlay and label mask in out_dir.
+
+    Module level so it can run in a worker process. segment_kwargs are
+    passed on to segment(). Returns the morphology table.
+    """
+    rgb = np.asarray(Image.open(Path(png_dir) / f"{slide}.png").convert("RGBA"))
+    filtered_labels, labels, mask, morphology_data = segment(img_roi=rgb, **segment_kwargs)
+
+    make_overlay_png(filtered_labels, morphology_data, out_path=str(Path(out_dir) / f"{slide}.png"), alpha=200)
+    np.save(Path(out_dir) / f"{slide}.npy", filtered_labels)
+
+    return morphology_data
+
+
+def schedule_batch(items, fn, cost=None, max_workers=None, memory_budget=None, executor=ProcessPoolExecutor):
+    """
+    Run fn over items concurrently and yield results as they finish.
+
+    Parameters:
+    -----------
+    items : list
+        Work items (e.g. slide names), submitted in order.
+    fn : callable
+        Called as fn(item) in the executor. With the default process pool it
+        must be picklable (a module level function or a functools.partial of one).
+    cost : callable, optional
+        Estimated memory (bytes) needed by fn(item).
+    max_workers : int, optional
+        Number of slides processed at once. Defaults to the CPU count.
+    memory_budget : int, optional
+        Upper bound (bytes) on the summed cost of running items. An item
+        larger than the whole budget still runs, but on its own.
+    executor : callable
+        Executor class (or factory) called with max_workers. Processes by
+        default, since most of segment() holds the GIL.
+
+    Yields (item, result, error) where exactly one of result/error is None.
+    """
+    max_workers = max(1, int(max_workers or os.cpu_count() or 1))
+    pending = deque((item, cost(item) if cost else 0) for item in items)
+    in_flight = {}
+    used = 0
+
+    with executor(max_workers=max_workers) as pool:
+        while pending or in_flight:
+            # Fill free worker slots while the memory budget allows it
+            while pending and len(in_flight) < max_workers:
+                item, c = pending[0]
+                if memory_budget and in_flight and used + c > memory_budget:
+                    break
+                pending.popleft()
+                try:
+                    fut = pool.submit(fn, item)
+                except Exception as e:
+                    # e.g. BrokenProcessPool after a worker was killed
+                    yield item, None, e
+                    continue
+                in_flight[fut] = (item, c)
+                used += c
+
+            if not in_flight:
+                continue
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for fut in done:
+                item, c = in_flight.pop(fut)
+                used -= c
+                try:
+                    yield item, fut.result(), None
+                except Exception as e:
+                    yield item, None, e
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# app.py imports the pipeline as `static.code...` relative to "Browser App"
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
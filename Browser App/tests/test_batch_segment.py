@@ -0,0 +1,84 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from static.code.segment_pipeline import schedule_batch
+
+
+class Recorder:
+    """Fake work function that records what runs at the same time.
+
+    With hold=n the first calls block until n of them run at once, so a
+    cap of n is observed without relying on sleeps.
+    """
+
+    def __init__(self, cost=lambda i: 0, fail=(), hold=None):
+        self.cost = cost
+        self.fail = set(fail)
+        self.hold = hold
+        self.reached = threading.Event()
+        self.lock = threading.Lock()
+        self.running = set()
+        self.peak_workers = 0
+        self.peak_cost = 0
+        self.alone = {}
+
+    def __call__(self, item):
+        with self.lock:
+            self.running.add(item)
+            self.alone[item] = self.running == {item}
+            self.peak_workers = max(self.peak_workers, len(self.running))
+            self.peak_cost = max(self.peak_cost, sum(self.cost(i) for i in self.running))
+            if self.hold and len(self.running) >= self.hold:
+                self.reached.set()
+        if self.hold:
+            assert self.reached.wait(timeout=5), "never reached {} concurrent calls".format(self.hold)
+        with self.lock:
+            self.alone[item] = self.alone[item] and self.running == {item}
+            self.running.discard(item)
+        if item in self.fail:
+            raise ValueError(f"bad {item}")
+        return item * 2
+
+
+def run(items, fn, **kwargs):
+    return list(schedule_batch(items, fn, executor=ThreadPoolExecutor, **kwargs))
+
+
+def test_worker_cap():
+    fn = Recorder(hold=3)
+    results = run(range(8), fn, max_workers=3)
+
+    assert sorted(r for _, r, _ in results) == [i * 2 for i in range(8)]
+    assert fn.peak_workers == 3
+
+
+def test_memory_budget_gates_submission():
+    fn = Recorder(cost=lambda i: 40, hold=2)
+    results = run(range(8), fn, cost=fn.cost, max_workers=8, memory_budget=100)
+
+    assert all(e is None for _, _, e in results)
+    assert fn.peak_workers == 2
+    assert fn.peak_cost <= 100
+
+
+def test_oversized_item_runs_alone():
+    fn = Recorder(cost=lambda i: 500 if i == 3 else 40)
+    results = run(range(6), fn, cost=fn.cost, max_workers=4, memory_budget=100)
+
+    assert len(results) == 6
+    assert fn.alone[3]
+
+
+def test_errors_are_yielded_per_item():
+    fn = Recorder(fail={2})
+    results = {item: (result, error) for item, result, error in run(range(4), fn, max_workers=2)}
+
+    assert results[2][0] is None
+    assert isinstance(results[2][1], ValueError)
+    assert all(results[i] == (i * 2, None) for i in (0, 1, 3))
+
+
+def test_default_executor_uses_processes():
+    results = list(schedule_batch([-1, -2, -3], abs, max_workers=2))
+
+    assert sorted(r for _, r, _ in results) == [1, 2, 3]
@@ -0,0 +1,167 @@
+import importlib
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from static.code.segment_pipeline import batch_segment, measure_morphology
+
+APP_DIR = Path(__file__).resolve().parents[1]
+
+PARAMS = {
+    "h_min": 0.0, "h_max": 1.0,
+    "s_min": 0.0, "s_max": 1.0,
+    "v_min": 0.0, "v_max": 1.0,
+    "do_watershed": False,
+    "do_morphology": False,
+    "morphfilter": {},
+}
+
+
+def fake_segment(img_roi, **kwargs):
+    """Stand-in for segment(): the red value of the first pixel is the number of objects."""
+    n = int(img_roi[0, 0, 0])
+    if n == 99:
+        raise RuntimeError("segmentation failed")
+    labels = np.zeros(img_roi.shape[:2], dtype=np.int32)
+    for i in range(n):
+        labels[2:5, 4 * i + 2:4 * i + 5] = i + 1
+    morphology_data = pd.DataFrame(measure_morphology(labels))
+    return labels, labels, labels > 0, morphology_data
+
+
+def write_slide(name, objects):
+    rgba = np.zeros((8, 40, 4), dtype=np.uint8)
+    rgba[..., 0] = objects
+    Image.fromarray(rgba, mode="RGBA").save(Path("cache/png") / f"{name}.png")
+
+
+def read_lines(response):
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    for d in ("cache/dzi", "cache/png", "cache/export", "cache/mask/tmp"):
+        (tmp_path / d).mkdir(parents=True)
+    (tmp_path / "static").symlink_to(APP_DIR / "static")
+    monkeypatch.chdir(tmp_path)
+
+    app = importlib.import_module("app")
+    monkeypatch.setattr(app, "BATCH_EXECUTOR", ThreadPoolExecutor)
+    monkeypatch.setattr(batch_segment, "segment", fake_segment)
+    return TestClient(app.app)
+
+
+def test_all_slides_streamed_and_combined(client):
+    write_slide("a", 2)
+    write_slide("b", 3)
+
+    response = client.post("/segment_batch", json={**PARAMS, "batch_id": "run1"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+
+    *slides, summary = read_lines(response)
+    assert {s["slide"]: s["count"] for s in slides} == {"a": 2, "b": 3}
+    assert all(len(s["measurements"]) == s["count"] for s in slides)
+    assert summary["batch_id"] == "run1"
+    assert summary["counts"] == {"a": 2, "b": 3}
+    assert summary["total"] == 5
+    assert summary["failed"] == []
+    assert summary["error"] is None
+    assert Path(summary["parquet"]) == Path("cache/mask/tmp/batch/run1/morphology")
+
+    # Partitioned by slide
+    assert sorted(p.name for p in Path(summary["parquet"]).iterdir()) == ["slide=a", "slide=b"]
+    csv = client.get("/morphology_batch/run1")
+    assert csv.status_code == 200
+    combined = pd.read_csv(io.StringIO(csv.text))
+    assert combined.groupby("slide").size().to_dict() == {"a": 2, "b": 3}
+
+    # Batch files stay in the batch folder; interactive results are untouched
+    assert Path("cache/mask/tmp/batch/run1/slides/a.npy").exists()
+    assert not Path("cache/mask/a.png").exists()
+    assert not Path("cache/mask/tmp/a.npy").exists()
+
+
+def test_filenames_strip_png_and_drop_duplicates(client):
+    write_slide("sample.2024", 1)
+    write_slide("sample", 4)
+    write_slide("b", 2)
+
+    response = client.post("/segment_batch", json={**PARAMS, "filenames": ["sample.2024.png", "sample.2024", "b"]})
+    *slides, summary = read_lines(response)
+
+    assert sorted(s["slide"] for s in slides) == ["b", "sample.2024"]
+    assert summary["counts"] == {"sample.2024": 1, "b": 2}
+
+
+def test_default_batch_ids_are_unique(client):
+    write_slide("a", 1)
+
+    first = read_lines(client.post("/segment_batch", json=PARAMS))[-1]["batch_id"]
+    second = read_lines(client.post("/segment_batch", json=PARAMS))[-1]["batch_id"]
+
+    assert first != second
+
+
+def test_failed_and_empty_slides(client):
+    write_slide("broken", 99)
+    write_slide("empty", 0)
+
+    *slides, summary = read_lines(client.post("/segment_batch", json={**PARAMS, "batch_id": "run2"}))
+
+    assert {s["slide"]: s.get("error") for s in slides} == {"broken": "segmentation failed", "empty": None}
+    assert summary["failed"] == ["broken"]
+    assert summary["counts"] == {"empty": 0}
+    assert summary["parquet"] is None
+    assert client.get("/morphology_batch/run2").status_code == 404
+
+
+def test_missing_slide_is_404(client):
+    write_slide("a", 1)
+    response = client.post("/segment_batch", json={**PARAMS, "filenames": ["a", "nope"]})
+    assert response.status_code == 404
+
+
+def test_unreadable_slide_is_400(client):
+    Path("cache/png/bad.png").write_bytes(b"not a png")
+    response = client.post("/segment_batch", json=PARAMS)
+    assert response.status_code == 400
+    assert "bad" in response.json()["detail"]
+
+
+def test_no_slides_is_400(client):
+    assert client.post("/segment_batch", json=PARAMS).status_code == 400
+
+
+@pytest.mark.parametrize("batch_id", ["..", ".", "a/b", "run\n"])
+def test_invalid_batch_id_is_400(client, batch_id):
+    write_slide("a", 1)
+    Path("cache/mask/tmp/keep.npy").write_bytes(b"")
+
+    response = client.post("/segment_batch", json={**PARAMS, "batch_id": batch_id})
+
+    assert response.status_code == 400
+    assert Path("cache/mask/tmp/keep.npy").exists()
+
+
+def test_invalid_batch_id_on_download_is_400(client):
+    assert client.get("/morphology_batch/a.b").status_code == 400
+
+
+def test_existing_batch_id_needs_overwrite(client):
+    write_slide("a", 1)
+    assert client.post("/segment_batch", json={**PARAMS, "batch_id": "run3"}).status_code == 200
+
+    assert client.post("/segment_batch", json={**PARAMS, "batch_id": "run3"}).status_code == 409
+
+    response = client.post("/segment_batch", json={**PARAMS, "batch_id": "run3", "overwrite": True})
+    assert response.status_code == 200
+    assert read_lines(response)[-1]["counts"] == {"a": 1}